@@ -0,0 +1,104 @@
+// direct conv2d forward with the im2col gather fused into an AVX2 microkernel, no patch buffer
+// out[b, co, Y, X] = sum_{c,ky,kx} x[b, g*cin+c, Y*sy+ky, X*sx+kx] * w[co, c, ky, kx]
+// compiled and loaded at runtime by extra.kernels.compile_c, see Conv2D in ops.py
+
+#include <immintrin.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stddef.h>
+
+#define NC 16  // output channels per tile, 2 ymm
+#define NX 6   // output columns per tile, 12 ymm accumulators + 2 weight + 1 broadcast register
+
+int has_avx2(void) {
+  __builtin_cpu_init();
+  return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma");
+}
+
+// weights repacked as [group][block][k][16] so a tile reads its 16 output channels for one k as 2 contiguous loads
+// channels past the end of a group are zero and never stored
+static float *pack_weights(const float *w, int groups, int g_w_chans, int nblk, int K) {
+  float *wp = aligned_alloc(32, (size_t)groups*nblk*K*NC*sizeof(float));
+  if (!wp) return NULL;
+  memset(wp, 0, (size_t)groups*nblk*K*NC*sizeof(float));
+  for (int g = 0; g < groups; g++)
+    for (int i = 0; i < g_w_chans; i++) {
+      const float *src = w + (size_t)(g*g_w_chans + i)*K;
+      float *dst = wp + ((size_t)g*nblk + i/NC)*K*NC + i%NC;
+      for (int k = 0; k < K; k++) dst[(size_t)k*NC] = src[k];
+    }
+  return wp;
+}
+
+// 16 output channels x 6 output columns of one output row, K streamed from x and the packed weights
+// every k step is 2 weight loads + 6 broadcasts feeding 12 FMAs
+__attribute__((target("avx2,fma")))
+static inline void kernel_16x6(const float *xg, const float *wb, float *ob, int nc, int Y, int X,
+                               int cin, int iy, int ix, int oy, int ox, int H, int W, int sy, int sx) {
+  __m256 a00 = _mm256_setzero_ps(), a01 = a00, a10 = a00, a11 = a00, a20 = a00, a21 = a00,
+         a30 = a00, a31 = a00, a40 = a00, a41 = a00, a50 = a00, a51 = a00;   // named, an array of them gets spilled
+  for (int c = 0; c < cin; c++) {
+    for (int ky = 0; ky < H; ky++) {
+      const float *row = xg + ((size_t)c*iy + Y*sy + ky)*ix + (size_t)X*sx;
+      for (int kx = 0; kx < W; kx++, wb += NC) {
+        __m256 w0 = _mm256_load_ps(wb), w1 = _mm256_load_ps(wb + 8), xv;
+        #define FMA(j) xv = _mm256_broadcast_ss(row + j*sx + kx); \
+          a##j##0 = _mm256_fmadd_ps(w0, xv, a##j##0); a##j##1 = _mm256_fmadd_ps(w1, xv, a##j##1);
+        FMA(0) FMA(1) FMA(2) FMA(3) FMA(4) FMA(5)
+        #undef FMA
+      }
+    }
+  }
+  // channels are in the lanes, out is NCHW, so write the tile out transposed
+  float t[NX][NC] __attribute__((aligned(32)));
+  __m256 acc[NX][2] = {{a00, a01}, {a10, a11}, {a20, a21}, {a30, a31}, {a40, a41}, {a50, a51}};
+  for (int j = 0; j < NX; j++) { _mm256_store_ps(t[j], acc[j][0]); _mm256_store_ps(t[j] + 8, acc[j][1]); }
+  size_t plane = (size_t)oy*ox, o = (size_t)Y*ox + X;
+  for (int i = 0; i < nc; i++)
+    for (int j = 0; j < NX; j++) ob[i*plane + o + j] = t[j][i];
+}
+
+// rows narrower than one tile
+static inline void kernel_scalar(const float *xg, const float *wb, float *ob, int nc, int Y, int X,
+                                 int cin, int iy, int ix, int oy, int ox, int H, int W, int sy, int sx) {
+  for (int i = 0; i < nc; i++) {
+    float acc = 0.0f;
+    for (int c = 0, k = 0; c < cin; c++)
+      for (int ky = 0; ky < H; ky++)
+        for (int kx = 0; kx < W; kx++, k++)
+          acc += xg[((size_t)c*iy + Y*sy + ky)*ix + (size_t)X*sx + kx] * wb[(size_t)k*NC + i];
+    ob[(size_t)i*oy*ox + (size_t)Y*ox + X] = acc;
+  }
+}
+
+// returns 0 on success, -1 if the packed weights couldn't be allocated
+__attribute__((target("avx2,fma")))
+int conv2d_fwd_f32(const float *x, const float *w, float *out, int bs, int cin, int cout, int groups,
+                   int iy, int ix, int H, int W, int sy, int sx) {
+  const int oy = (iy-H)/sy + 1, ox = (ix-W)/sx + 1, g_w_chans = cout/groups, nblk = (g_w_chans+NC-1)/NC, K = cin*H*W;
+  float *wp = pack_weights(w, groups, g_w_chans, nblk, K);
+  if (!wp) return -1;
+  // one (image, group, output row) per task, its input rows stay in cache while every channel block sweeps them
+  #pragma omp parallel for collapse(3) schedule(static)
+  for (int b = 0; b < bs; b++) {
+    for (int g = 0; g < groups; g++) {
+      for (int Y = 0; Y < oy; Y++) {
+        const float *xg = x + ((size_t)b*groups + g)*cin*iy*ix;
+        for (int blk = 0; blk < nblk; blk++) {
+          int co = g*g_w_chans + blk*NC, nc = g_w_chans - blk*NC < NC ? g_w_chans - blk*NC : NC;
+          const float *wb = wp + ((size_t)g*nblk + blk)*K*NC;
+          float *ob = out + ((size_t)b*cout + co)*oy*ox;
+          if (ox < NX) {
+            for (int X = 0; X < ox; X++) kernel_scalar(xg, wb, ob, nc, Y, X, cin, iy, ix, oy, ox, H, W, sy, sx);
+            continue;
+          }
+          // the last tile is shifted left to end at ox, recomputing a few columns instead of a ragged tail
+          for (int X = 0; X < ox; X += NX)
+            kernel_16x6(xg, wb, ob, nc, Y, X + NX > ox ? ox - NX : X, cin, iy, ix, oy, ox, H, W, sy, sx);
+        }
+      }
+    }
+  }
+  free(wp);
+  return 0;
+}
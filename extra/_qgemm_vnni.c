@@ -0,0 +1,80 @@
+// u8 x s8 -> s32 GEMM for QDot, the inner product runs on VPDPBUSD (AVX512-VNNI)
+// c[m, n] = (sum_k a[m, k] * b[k, n] - zp*bsum[n]) * scale[n], a is (M, K) uint8, b int8 prepacked by pack_int8 in ops.py
+// compiled and loaded at runtime by extra.kernels.compile_c, see QDot in ops.py
+
+#include <immintrin.h>
+#include <stdint.h>
+#include <stddef.h>
+#include <string.h>
+
+#define MR 6  // rows of a per tile
+#define NR 4  // 16 column blocks of b per tile, 24 zmm accumulators + 4 b + 1 broadcast register
+
+int has_vnni(void) {
+  __builtin_cpu_init();
+  return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vnni");
+}
+
+// q[m, k] = clip(round(x[m, k] * inv_scale) + zp, 0, 255) for the (M, K) float rows of x, the row tail up to Kp is zeroed
+// rows of q past M are left alone, qgemm_u8s8 computes them but never stores them
+__attribute__((target("avx512f,avx512vnni")))
+void quantize_u8(const float *x, uint8_t *q, int M, int K, int Kp, float inv_scale, int zp) {
+  const __m512 s = _mm512_set1_ps(inv_scale);
+  const __m512i z = _mm512_set1_epi32(zp), lo = _mm512_setzero_si512();
+  for (int m = 0; m < M; m++) {
+    const float *xr = x + (size_t)m*K;
+    uint8_t *qr = q + (size_t)m*Kp;
+    for (int k = 0; k < K; k += 16) {
+      __mmask16 mask = K-k >= 16 ? 0xFFFF : (__mmask16)((1u << (K-k)) - 1);
+      __m512i v = _mm512_add_epi32(_mm512_cvtps_epi32(_mm512_mul_ps(_mm512_maskz_loadu_ps(mask, xr + k), s)), z);  // round to nearest even
+      _mm512_mask_cvtusepi32_storeu_epi8(qr + k, mask, _mm512_max_epi32(v, lo));                                  // unsigned saturation clips at 255
+    }
+    memset(qr + K, 0, Kp - K);
+  }
+}
+
+// b is packed as [N/16][K/4][16][4]: 4 consecutive k of 16 columns, exactly one VPDPBUSD operand, no horizontal sums
+// the block count is a multiple of NR, bsum and scale are zero padded to match
+// a has K a multiple of 4 and its row count rounded up to a multiple of MR, only the first M rows of c are stored
+__attribute__((target("avx512f,avx512vnni")))
+void qgemm_u8s8(const uint8_t *a, const int8_t *b, const int32_t *bsum, const float *scale, float *c,
+                int M, int N, int K, int zp) {
+  const int ntile = ((N+15)/16 + NR-1)/NR;
+  const __m512i zpv = _mm512_set1_epi32(zp);
+  #pragma omp parallel for collapse(2) schedule(static)
+  for (int m = 0; m < M; m += MR) {
+    for (int t = 0; t < ntile; t++) {
+      const int8_t *bt = b + (size_t)t*NR*K*16;
+      __m512i acc[MR][NR];
+      #pragma GCC unroll 6
+      for (int i = 0; i < MR; i++)
+        #pragma GCC unroll 4
+        for (int j = 0; j < NR; j++) acc[i][j] = _mm512_setzero_si512();
+      for (int k = 0; k < K; k += 4) {
+        __m512i bv[NR];
+        #pragma GCC unroll 4
+        for (int j = 0; j < NR; j++) bv[j] = _mm512_loadu_si512(bt + ((size_t)j*K + k)*16);
+        #pragma GCC unroll 6
+        for (int i = 0; i < MR; i++) {
+          int32_t a4;
+          memcpy(&a4, a + (size_t)(m+i)*K + k, 4);
+          __m512i av = _mm512_set1_epi32(a4);
+          #pragma GCC unroll 4
+          for (int j = 0; j < NR; j++) acc[i][j] = _mm512_dpbusd_epi32(acc[i][j], av, bv[j]);
+        }
+      }
+      // constant trip counts so acc stays in registers, rows and columns past the end are skipped inside
+      #pragma GCC unroll 6
+      for (int i = 0; i < MR; i++) {
+        #pragma GCC unroll 4
+        for (int j = 0; j < NR; j++) {
+          int n = (t*NR + j)*16;
+          if (m+i >= M || n >= N) continue;
+          __m512i s = _mm512_sub_epi32(acc[i][j], _mm512_mullo_epi32(zpv, _mm512_loadu_si512(bsum + n)));
+          __m512 v = _mm512_mul_ps(_mm512_cvtepi32_ps(s), _mm512_loadu_ps(scale + n));
+          _mm512_mask_storeu_ps(c + (size_t)(m+i)*N + n, N-n >= 16 ? 0xFFFF : (__mmask16)((1u << (N-n)) - 1), v);
+        }
+      }
+    }
+  }
+}
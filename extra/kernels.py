@@ -0,0 +1,54 @@
+# optional C kernels for froog.ops, compiled with the system C compiler on first use and loaded with ctypes
+# froog falls back to numpy when this module, a compiler or the CPU instructions are missing
+
+import ctypes, hashlib, os, pathlib, subprocess, tempfile
+import numpy as np
+
+def compile_c(src, flags=()):
+  """
+  compiles a C file into a shared library once, cached by source hash in the user cache dir, and loads it with ctypes
+  raises OSError or CalledProcessError when there is no working compiler
+  """
+  src = pathlib.Path(src)
+  fp = pathlib.Path(os.getenv("XDG_CACHE_HOME", pathlib.Path.home() / ".cache")) / "froog" / "lib" / (hashlib.md5(src.read_bytes() + " ".join(flags).encode('utf-8')).hexdigest() + ".so")
+  if not fp.is_file():
+    (path := fp.parent).mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path, suffix=".so", delete=False) as f:
+      subprocess.check_output([os.getenv("CC", "cc"), "-shared", "-fPIC", "-O3", *flags, str(src), "-o", f.name], stderr=subprocess.STDOUT)
+      pathlib.Path(f.name).rename(fp)
+  return ctypes.CDLL(str(fp))
+
+_c_libs = {}
+def load_c(name, check, **fxns):
+  """
+  builds one of the C kernels next to this file on first use and sets fxns={name: (argtypes, restype)}
+  None if there is no compiler or the CPU lacks the instructions, either answer is kept for the rest of the process
+  """
+  if name not in _c_libs:
+    _c_libs[name] = None
+    for flags in (("-fopenmp",), ()):
+      try:
+        lib = compile_c(pathlib.Path(__file__).parent / name, flags)
+      except FileNotFoundError:                                              # no compiler at all, retrying without OpenMP won't help
+        break
+      except (OSError, subprocess.CalledProcessError):
+        continue
+      if getattr(lib, check)():
+        for fxn, (argtypes, restype) in fxns.items():
+          getattr(lib, fxn).argtypes, getattr(lib, fxn).restype = argtypes, restype
+        _c_libs[name] = lib
+      break
+  return _c_libs[name]
+
+f32 = np.ctypeslib.ndpointer(np.float32, flags="C_CONTIGUOUS")
+
+AVX2 = True  # fused im2col+GEMM conv forward, set False to stay on numpy
+def conv_avx2():
+  return load_c("_conv_avx2.c", "has_avx2", conv2d_fwd_f32=([f32, f32, f32] + [ctypes.c_int]*10, ctypes.c_int)) if AVX2 else None
+
+VNNI = True  # int8 GEMM for QDot, set False to stay on numpy
+def qgemm_vnni():
+  # raw pointers, QDot allocates every buffer it passes and ndpointer's checks cost more than a small GEMM
+  return load_c("_qgemm_vnni.c", "has_vnni", qgemm_u8s8=([ctypes.c_void_p]*5 + [ctypes.c_int]*4, None),
+                quantize_u8=([ctypes.c_void_p]*2 + [ctypes.c_int]*3 + [ctypes.c_float, ctypes.c_int], None)) if VNNI else None
+
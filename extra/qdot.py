@@ -0,0 +1,74 @@
+# int8 quantized matmul for inference, importing this registers Tensor.qdot
+# uses the AVX512-VNNI kernel from extra.kernels when it builds, numpy otherwise
+
+import weakref
+import numpy as np
+from froog.tensor import Function, register
+from froog.utils import quantize
+from extra.kernels import qgemm_vnni
+
+def pack_int8(wq):
+  """
+  int8 (K, N) weight -> the [N/16][K/4][16][4] blocks qgemm_u8s8 reads and its column sums for the zero point
+  K is padded to a multiple of 4 and N to whole 64 column tiles, zeros add nothing to the int32 sums
+  """
+  K, N = wq.shape
+  Kp, Np = -(-K//4)*4, -(-N//64)*64
+  wp = np.pad(wq, ((0, Kp-K), (0, Np-N))).reshape(Kp//4, 4, Np//16, 16).transpose(2, 0, 3, 1)
+  return np.ascontiguousarray(wp), np.pad(wq.sum(axis=0, dtype=np.int32), (0, Np-N))
+
+_qweights = {}  # {id(int8 weight): pack_int8(weight)}, dropped when the weight is freed
+def pack_qweight(wq):
+  if id(wq) not in _qweights:
+    _qweights[id(wq)] = pack_int8(wq)
+    weakref.finalize(wq, _qweights.pop, id(wq), None)
+  return _qweights[id(wq)]
+
+class QDot(Function):  # x.qdot(y) or x.qdot(y.quantize(scale), scale=scale)
+  """
+  int8 inference matmul
+  input is quantized per call to uint8 with a zero point, weight is symmetric int8 with a scale per output column and no zero point
+  a float weight is quantized every call, an int8 one from Tensor.quantize is packed once and treated as frozen
+  x @ w ~= xs*ws * (xq @ wq - xz*sum_k(wq)), accumulated exactly in int32
+  gradients are straight-through, i.e. the same as Dot on the float inputs. int8 weights get none
+  """
+  @staticmethod
+  def forward(ctx, input, weight, scale=None):
+    if weight.dtype == np.int8 and scale is None:
+      raise ValueError("qdot: an int8 weight needs its scale, x.qdot(w.quantize(s), scale=s)")
+    shape, input = input.shape, input.reshape(-1, input.shape[-1])           # batched input as (rows, K), reshaped back at the end
+    ctx.save_for_backward(input, weight, shape)
+    lo, hi = min(input.min(), 0), max(input.max(), 0)                       # range has to include 0 so it quantizes exactly
+    xs = (hi - lo) / 255 or 1.0
+    xz = int(round(-lo / xs))
+    if weight.dtype == np.int8:
+      wq, ws = weight, np.broadcast_to(np.asarray(scale, dtype=np.float32), weight.shape[1:])
+    else:
+      ws = np.abs(weight).max(axis=0) / 127
+      ws[ws == 0] = 1.0
+      wq = quantize(weight, ws, 0, np.int8)
+    (M, K), N = input.shape, wq.shape[1]
+
+    if (lib := qgemm_vnni()) is not None:
+      wp, wsum = pack_qweight(wq) if wq is weight else pack_int8(wq)
+      input = np.ascontiguousarray(input, dtype=np.float32)
+      xq = np.empty((-(-M//6)*6, wp.shape[1]*4), dtype=np.uint8)           # rows to whole 6 row tiles, K to the packed depth
+      lib.quantize_u8(input.ctypes.data, xq.ctypes.data, M, K, xq.shape[1], 1/xs, xz)
+      scale = np.zeros(wsum.shape, dtype=np.float32)
+      scale[:N] = xs * ws
+      ret = np.empty((M, N), dtype=np.float32)
+      lib.qgemm_u8s8(*(a.ctypes.data for a in (xq, wp, wsum, scale, ret)), M, N, xq.shape[1], xz)  # zero point and scales applied in the kernel
+      return ret.reshape(*shape[:-1], N)
+    xq = quantize(input, xs, xz, np.uint8)
+    acc = np.matmul(xq.astype(np.float64), wq.astype(np.float64))           # float64 BLAS is exact for these integer sums
+    acc -= xz * wq.sum(axis=0, dtype=np.int64)
+    return (acc * (xs * ws)).astype(np.float32).reshape(*shape[:-1], N)
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    input, weight, shape = ctx.saved_tensors
+    grad_output = grad_output.reshape(-1, grad_output.shape[-1])
+    if weight.dtype == np.int8:
+      return np.matmul(grad_output, (weight * ctx.scale).astype(np.float32).T).reshape(shape), None  # frozen, dequantized just for the input grad
+    return np.matmul(grad_output, weight.T).reshape(shape), np.matmul(input.T, grad_output)
+register('qdot', QDot)
@@ -10,6 +10,11 @@ import numpy as np
 from froog.tensor import Function, register
 from froog.utils import im2col, col2im
 
+try:
+  from extra.kernels import conv_avx2  # optional C kernel, only in a source checkout
+except ImportError:
+  conv_avx2 = lambda: None
+
 # *****************************************************
 #     ____  ___   _____ __________   ____  ____  _____
 #    / __ )/   | / ___//  _/ ____/  / __ \/ __ \/ ___/
@@ -59,24 +64,29 @@ class Sum(Function): # x.sum()
   """
   @staticmethod
   def forward(ctx, input):
-    ctx.save_for_backward(input)
-    return np.array([input.sum()])
+    ctx.save_for_backward(input.shape)
+    return np.add.reduce(input, axis=None).reshape(1)                # 0-d result straight to shape (1,), keeps input's dtype
 
   @staticmethod
   def backward(ctx, grad_output):
-    (input,) = ctx.saved_tensors
-    return grad_output * np.ones_like(input)
+    (shape,) = ctx.saved_tensors
+    return np.broadcast_to(grad_output.reshape(()), shape)           # zero-copy view, every input gets the same gradient
 register("sum", Sum)
 
 class Pow(Function): # x.pow(y)
   @staticmethod
   def forward(ctx, x, y):
+    k = y.flat[0]
+    ctx.int_exp = y.size == 1 and float(k).is_integer()             # scalar integer exponent, e.g. x**2 in MSE
     ctx.save_for_backward(x, y)
-    return x ** y
+    return x ** (k if ctx.int_exp else y)                           # scalar exponent hits numpy's fast paths (square, reciprocal)
   
   @staticmethod
   def backward(ctx, grad_output):
     x, y = ctx.saved_tensors
+    if ctx.int_exp:
+      k = y.flat[0]
+      return k * (x**(k-1)) * grad_output, None                     # skip d/dy, its log(x) is the expensive part and NaN for x < 0
     return y * (x**(y-1.0)) * grad_output, (x**y) * np.log(x) * grad_output # power rule, d/dx (y^x)
 register("pow", Pow)
 
@@ -94,18 +104,19 @@ class Dot(Function):  # x.dot(y)
   @staticmethod
   def forward(ctx, input, weight):
     ctx.save_for_backward(input, weight)
-    return input.dot(weight)
+    return np.matmul(input, weight)
 
   @staticmethod
   def backward(ctx, grad_output):
     input, weight = ctx.saved_tensors
-    grad_input = grad_output.dot(weight.T)
-    grad_weight = input.T.dot(grad_output)
+    grad_input = np.matmul(grad_output, weight.T)   # .T is a view, BLAS reads it with a transpose flag, no copy
+    grad_weight = np.matmul(input.T, grad_output)
     return grad_input, grad_weight
 register('dot', Dot)
 register('matmul', Dot)
 
 
+
 # ***********************************************************
 #    _____ ______  _______  __    ______   ____  ____  _____
 #   / ___//  _/  |/  / __ \/ /   / ____/  / __ \/ __ \/ ___/
@@ -118,21 +129,23 @@ register('matmul', Dot)
 class ReLU(Function): 
   @staticmethod
   def forward(ctx, input):
-    ctx.save_for_backward(input)
-    return np.maximum(input, 0)                     # relu(x) = max(0,x)
+    ctx.save_for_backward(np.packbits(input >= 0), input.shape) # keep 1 bit/elem for backward instead of the whole input
+    return np.maximum(input, 0)                                # relu(x) = max(0,x)
 
   @staticmethod
   def backward(ctx, grad_output):
-    input, = ctx.saved_tensors
-    grad_input = grad_output * (input >= 0)
+    bits, shape = ctx.saved_tensors
+    mask = np.unpackbits(bits, count=grad_output.size).view(np.bool_).reshape(shape)
+    grad_input = grad_output * mask
     return grad_input
 register("relu", ReLU)
 
 class Sigmoid(Function): 
   @staticmethod
   def forward(ctx, input):
-    ctx.save_for_backward(input)
-    ret = 1/(1 + np.exp(-input))                    # sigmoid(x) = 1 / (1 + exp(-x))
+    ret = np.negative(input)                        # the only allocation, every later step is in place
+    np.reciprocal(np.add(np.exp(ret, out=ret), 1, out=ret), out=ret)  # sigmoid(x) = 1 / (1 + exp(-x))
+    ctx.save_for_backward(ret)
     return ret 
 
   @staticmethod
@@ -174,18 +187,18 @@ class LogSoftmax(Function):
   """
   @staticmethod
   def forward(ctx, input):
-    def logsumexp(x):
-      c = x.max(axis=1)
-      return c + np.log(np.exp(x - c.reshape((-1, 1))).sum(axis=1)) # axis=1 refers to the columns
-
-    output = input - logsumexp(input).reshape((-1, 1))
-    ctx.save_for_backward(output)
+    output = input - input.max(axis=1, keepdims=True)                       # shift by the max for stability, axis=1 refers to the columns
+    softmax = np.exp(output)
+    s = softmax.sum(axis=1, keepdims=True)
+    output -= np.log(s)                                                     # log(softmax) = x - c - log(sum(exp(x - c)))
+    softmax /= s                                                            # in place, backward needs exp(output) and this is it
+    ctx.save_for_backward(softmax)
     return output
 
   @staticmethod
   def backward(ctx, grad_output):
-    (output,) = ctx.saved_tensors
-    return grad_output - np.exp(output)*(grad_output.sum(axis=1).reshape((-1, 1)))
+    (softmax,) = ctx.saved_tensors
+    return grad_output - softmax*grad_output.sum(axis=1, keepdims=True)
 register("logsoftmax", LogSoftmax)
 
 
@@ -198,6 +211,18 @@ register("logsoftmax", LogSoftmax)
 #
 # ****************** conv ops *****************
 
+_im2col_cache = {}               # {(shape, dtype): ndarray}, im2col buffers handed back by Conv2D.backward for the next forward
+
+def cached_im2col(x, H, W, stride, groups):
+  """
+  im2col into a buffer from _im2col_cache, (bs, groups, cin*H*W, oy*ox). the caller owns it until it hands it back
+  """
+  bs, oy, ox = x.shape[0], (x.shape[2]-H)//stride[0] + 1, (x.shape[3]-W)//stride[1] + 1
+  key = ((bs, x.shape[1]*H*W, oy*ox), x.dtype)
+  buf = _im2col_cache.pop(key, None)                                        # take ownership so no other conv overwrites it before our backward
+  tx = im2col(x, H, W, stride, out=buf if buf is not None else np.empty(*key))
+  return tx.reshape(bs, groups, -1, oy*ox)                                  # every receptive field as a column, split per group
+
 class Conv2D(Function): # TODO: understand group splits
   @staticmethod
   def forward(ctx, x, w, stride=1, groups=1):
@@ -218,7 +243,6 @@ class Conv2D(Function): # TODO: understand group splits
 
     cout, cin, H, W = w.shape
 
-    tw = w.reshape(cout, -1).T                                                                            # slice of kernel 
     y_stride, x_stride = ctx.stride
 
     bs,cin_,oy,ox = x.shape[0], x.shape[1], (x.shape[2]-(H-y_stride))//y_stride, (x.shape[3]-(W-x_stride))//x_stride
@@ -226,69 +250,64 @@ class Conv2D(Function): # TODO: understand group splits
     assert cout % ctx.groups == 0                                                                         # ensures that the number of output channels can be evenly divided among the groups
     g_w_chans = cout//ctx.groups                                                                          # number of output channels per group
 
-    ctx.save_for_backward(x, w)
-    ret = np.zeros((bs, cout, oy, ox), dtype=w.dtype)
-    
+    ctx.pointwise = H == 1 and W == 1 and ctx.stride == (1,1) and ctx.groups == 1                         # 1x1 conv is just a GEMM, no im2col needed
+    if ctx.pointwise:
+      ctx.save_for_backward(x, w)
+      return np.matmul(w.reshape(cout, cin), x.reshape(bs, cin, oy*ox)).reshape(bs, cout, oy, ox)      # (cout, cin) @ (bs, cin, oy*ox), already NCHW
+
+    lib = conv_avx2() if x.dtype == w.dtype == np.float32 else None
+    ctx.fused = lib is not None                                                                           # im2col gather fused into the GEMM microkernel
+    if ctx.fused:
+      x = np.ascontiguousarray(x)
+      ctx.save_for_backward(x, w)                                                                         # backward rebuilds the im2col matrix from x
+      ret = np.empty((bs, cout, oy, ox), dtype=w.dtype)
+      if lib.conv2d_fwd_f32(x, np.ascontiguousarray(w), ret, bs, cin, cout, ctx.groups, x.shape[2], x.shape[3], H, W, y_stride, x_stride):
+        raise MemoryError("conv2d: couldn't allocate the packed weights")
+      return ret
+
+    tx = cached_im2col(x, H, W, ctx.stride, ctx.groups)
+    ctx.save_for_backward(tx, w, x.shape)                                                                 # backward reuses the im2col matrix
+    ret = np.empty((bs, cout, oy*ox), dtype=w.dtype)
+
     for g in range(ctx.groups):
-      tw = w[g*g_w_chans:(g*g_w_chans+g_w_chans)].reshape(g_w_chans, -1).T                                # transformed kernel weights
-      for Y in range(oy):
-        for X in range(ox):
-          iY,iX = Y*y_stride, X*x_stride
-          tx = x[:, g*cin:(g*cin+cin), iY:iY+H, iX:iX+W].reshape(bs, -1)
-          ret[:, g*g_w_chans:(g*g_w_chans+g_w_chans), Y, X] += tx.dot(tw)
-    return ret
+      tw = w[g*g_w_chans:(g*g_w_chans+g_w_chans)].reshape(g_w_chans, -1)                                  # transformed kernel weights
+      np.matmul(tw, tx[:, g], out=ret[:, g*g_w_chans:(g*g_w_chans+g_w_chans)])                            # (g_w_chans, K) @ (bs, K, oy*ox), straight into NCHW
+    return ret.reshape(bs, cout, oy, ox)
 
   @staticmethod
   def backward(ctx, grad_output):
-    x, w = ctx.saved_tensors
+    if ctx.pointwise:
+      x, w = ctx.saved_tensors
+      bs, cin = x.shape[:2]
+      gg = grad_output.reshape(bs, w.shape[0], -1)                                                        # (bs, cout, oy*ox)
+      dw = np.tensordot(gg, x.reshape(bs, cin, -1), axes=([0,2], [0,2])).reshape(w.shape)                # sum over batch and pixels in one GEMM
+      dx = np.matmul(w.reshape(-1, cin).T, gg).reshape(x.shape)
+      return dx, dw
+
+    if ctx.fused:
+      x, w = ctx.saved_tensors
+      tx, x_shape = cached_im2col(x, *w.shape[2:], ctx.stride, ctx.groups), x.shape
+    else:
+      tx, w, x_shape = ctx.saved_tensors
+    bs = x_shape[0]
     cout, cin, H, W = w.shape
-    dx, dw = np.zeros_like(x), np.zeros_like(w)                                         
-    y_stride, x_stride = ctx.stride
     g_w_chans = cout//ctx.groups
 
+    gg = grad_output.reshape(bs, cout, -1)                                                                # (bs, cout, oy*ox), current multiply element in chain rule
+    dw, dxi = np.empty_like(w), np.empty_like(tx)
+
     for g in range(ctx.groups):
+      ggg = gg[:, g*g_w_chans:(g*g_w_chans+g_w_chans)]
       tw = w[g*g_w_chans:(g*g_w_chans+g_w_chans)].reshape(g_w_chans, -1)
-      for Y in range(grad_output.shape[2]):
-        for X in range(grad_output.shape[3]):
-          iY,iX = Y*y_stride, X*x_stride
-          gg = grad_output[:, g*g_w_chans:(g*g_w_chans+g_w_chans), Y, X]                                  # current multiply element in chain rule
-          tx = x[:, g*cin:(g*cin+cin), iY:iY+H, iX:iX+W].reshape(x.shape[0], -1)                          # slice of tensor at current conv op        
-          dw[g*g_w_chans:(g*g_w_chans+g_w_chans)] += gg.T.dot(tx).reshape((g_w_chans,cin,H,W))            # gradient with respect to input
-          dx[:, g*cin:(g*cin+cin), iY:iY+H, iX:iX+W] += gg.dot(tw).reshape(dx.shape[0], cin, H, W)        # accumulate gradient with respect to weights 
+      dw[g*g_w_chans:(g*g_w_chans+g_w_chans)] = np.matmul(ggg, tx[:, g].transpose(0, 2, 1)).sum(axis=0).reshape((g_w_chans,cin,H,W))  # gradient with respect to weights
+      np.matmul(tw.T, ggg, out=dxi[:, g])                                                                 # gradient with respect to input columns
+    dx = col2im(dxi.reshape(bs, -1, dxi.shape[3]), H, W, x_shape[2], x_shape[3], ctx.stride)             # scatter columns back into image shape
+    buf = tx.reshape(bs, -1, tx.shape[3])
+    _im2col_cache[(buf.shape, buf.dtype)] = buf                                                           # done with it, next forward of this shape reuses it
     return dx, dw
 register('conv2d', Conv2D)
 
 
-class im2ColConv(Function):
-  """
-  uses im2col
-  https://leonardoaraujosantos.gitbook.io/artificial-inteligence/machine_learning/deep_learning/convolution_layer/making_faster
-  """
-
-  @staticmethod
-  def forward(ctx, x, w):
-    cout, cin, k_h, k_x = w.shape
-    bs, oy, ox = x.shape[0], x.shape[2]-(k_h-1), x.shape[3]-(k_x-1)
-    tw = w.reshape(cout, -1).T                                             # each filter flattened into a row
-    tx = im2col(x, k_h, k_x)                                               # im2col, turn input into column
-    ctx.save_for_backward(tx, w)                                           # save the im2col output
-    ret = tx.dot(tw).reshape(bs, oy, ox, cout)                             # now the conv has been transoforned into a GEMM
-    return np.moveaxis(ret, [0,1,2,3], [0,2,3,1])                          # reorders the axes (batch size, number of channels, height, width)
-
-  @staticmethod
-  def backward(ctx, grad_output):
-    bs,_,oy,ox = grad_output.shape
-    tx, w = ctx.saved_tensors                                              # transformed input, filter weights 
-    cout,cin,H,W = w.shape
-    tw = w.reshape(cout, -1)                                               # flatten filter and stack onto other channel filters
-    gg = np.moveaxis(grad_output, [0,1,2,3], [1,0,2,3]).reshape(cout, -1)  # order correctly
-    dw = gg.dot(tx).reshape(w.shape)                                       # compute gradient of weight
-    dxi = gg.T.dot(tw)                                                     # compute gradient of input
-    dx = col2im(dxi, H, W, oy+(H-1), ox+(W-1))                             # turn columns back into image shape
-    return dx, dw
-register('im2col2dconv', im2ColConv)
-
-
 # *************************************************
 #     ____  ____  ____  __       ____  ____  _____
 #    / __ \/ __ \/ __ \/ /      / __ \/ __ \/ ___/
@@ -299,13 +318,10 @@ register('im2col2dconv', im2ColConv)
 # **************** pooling ops ***************
 
 def stack_for_pool(x, pool_y, pool_x):
-  my, mx = (x.shape[2]//pool_y)*pool_y, (x.shape[3]//pool_x)*pool_x        # ensures input tensor can be evenly divided into 2x2 blocks for max pooling
-  stack = []
-  cropped_x = x[:, :, :my, :mx]                                            # crop input so 2x2 max pool can be taken
-  for Y in range(pool_y):
-      for X in range(pool_x):
-        stack.append(cropped_x[:, :, Y::pool_y, X::pool_x][None])          # ::2 so 2x2 goes to next pool, [None] is numpy way to add an extra dimension so we can concatenate
-  return np.concatenate(stack, axis=0)                                     # put all into one row
+  bs, c, oy, ox = x.shape[0], x.shape[1], x.shape[2]//pool_y, x.shape[3]//pool_x
+  cropped_x = x[:, :, :oy*pool_y, :ox*pool_x]                              # crop input so the pool tiles it evenly, e.g. into 2x2 blocks
+  x6d = cropped_x.reshape(bs, c, oy, pool_y, ox, pool_x)                   # split each spatial axis into (out, pool), a view only if nothing was cropped
+  return x6d.transpose(3, 5, 0, 1, 2, 4).reshape(pool_y*pool_x, bs, c, oy, ox)  # one row per position in the pool, index Y*pool_x+X
 
 
 def unstack_for_pool(fxn, s, py, px):
@@ -335,9 +351,7 @@ class MaxPool2D(Function):
     The expression (Y*2+X) is a way to iterate through the four possible positions within the kernel block: e.g. (0,0), (0,1), (1,0), and (1,1), which get mapped to the indices 0, 1, 2, and 3 
     """
     idxs, s = ctx.saved_tensors                                     
-    return unstack_for_pool(lambda idx: grad_output * (idxs == idx), 
-                            s,
-                            *ctx.kernel_size)
+    return unstack_for_pool(lambda idx: grad_output * (idxs == idx), s, *ctx.kernel_size)
 register('max_pool2d', MaxPool2D)
 
 class AvgPool2D(Function):
@@ -351,10 +365,5 @@ class AvgPool2D(Function):
   def backward(ctx, grad_output):
     s, = ctx.saved_tensors
     py, px = ctx.kernel_size                                  # kernel_size passed from forward context
-    my, mx = (s[2]//py)*py, (s[3]//px)*px
-    ret = np.zeros(s, dtype=grad_output.dtype)
-    for Y in range(py):
-      for X in range(px):
-        ret[:, :, Y:my:py, X:mx:px] = grad_output / py / px   # divide by avg of pool, e.g. for 2x2 pool /= 4
-    return ret
+    return unstack_for_pool(lambda idx: grad_output / py / px, s, py, px)  # divide by avg of pool, e.g. for 2x2 pool /= 4
 register('avg_pool2d', AvgPool2D)
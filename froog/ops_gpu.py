@@ -416,6 +416,7 @@ class Conv2D(Function):
     }
     """)
 
+    ctx.save_for_backward(x, w)
     prg.conv(ctx.cl_queue, [bs*groups*rcout, oy, ox], None,
       x, w, ret,
       np.int32(H), np.int32(W),
@@ -425,9 +426,44 @@ class Conv2D(Function):
       np.int32(ys), np.int32(xs)
     )
     return ret
+
   @staticmethod
   def backward(ctx, grad_output):
-    raise Exception("not implemented")
+    x, w = ctx.saved_tensors
+    (cout,cin,H,W), (ys,xs), (bs,_,iy,ix), (oy,ox) = w.shape, ctx.stride, x.shape, grad_output.shape[2:]
+    groups, rcout = ctx.groups, cout//ctx.groups
+    dx, dw = buffer_like(ctx, x), buffer_like(ctx, w)
+    # one work item per gradient element, so nothing needs atomics. gg(B, g, c, Y, X) indexes grad_output
+    prg = clbuild(ctx.cl_ctx, """
+    #define gg(B, g, c, Y, X) ggg[(((B)*groups + (g))*rcout + (c))*oy*ox + (Y)*ox + (X)]
+    __kernel void convw(__global const float *tensx, __global const float *ggg, __global float *dw,
+      int H, int W, int groups, int rcout, int cin, int oy, int ox, int iy, int ix, int ys, int xs, int bs) {
+      int g = get_global_id(0)/rcout, c = get_global_id(0)%rcout, ci = get_global_id(1);
+      int y = get_global_id(2)/W, x = get_global_id(2)%W;  // kernel position
+      // dw[g, c, ci, y, x] = sum over B, Y, X of grad[B, g, c, Y, X] * input[B, g, ci, Y*ys+y, X*xs+x]
+      float acc = 0.0;
+      for (int B = 0; B < bs; B++) for (int Y = 0; Y < oy; Y++) for (int X = 0; X < ox; X++)
+        acc += gg(B, g, c, Y, X) * tensx[((B*groups + g)*cin + ci)*iy*ix + (Y*ys+y)*ix + X*xs+x];
+      dw[get_global_id(0)*cin*H*W + ci*H*W + y*W + x] = acc;
+    }
+
+    __kernel void convx(__global const float *tensw, __global const float *ggg, __global float *dx,
+      int H, int W, int groups, int rcout, int cin, int oy, int ox, int iy, int ix, int ys, int xs, int bs) {
+      int B = get_global_id(0)/groups, g = get_global_id(0)%groups, ci = get_global_id(1);
+      int IY = get_global_id(2)/ix, IX = get_global_id(2)%ix;  // input position
+      // dx[B, g, ci, IY, IX] = sum over every output (Y, X) whose window covers (IY, IX)
+      float acc = 0.0;
+      for (int c = 0; c < rcout; c++) for (int y = 0; y < H && y <= IY; y++) for (int x = 0; x < W && x <= IX; x++) {
+        int Y = (IY-y)/ys, X = (IX-x)/xs;
+        if ((IY-y)%ys == 0 && (IX-x)%xs == 0 && Y < oy && X < ox) acc += gg(B, g, c, Y, X) * tensw[((g*rcout + c)*cin + ci)*H*W + y*W + x];
+      }
+      dx[((B*groups + g)*cin + ci)*iy*ix + IY*ix + IX] = acc;
+    }
+    """)
+    conv_args = [np.int32(a) for a in (H, W, groups, rcout, cin, oy, ox, iy, ix, ys, xs, bs)]
+    prg.convw(ctx.cl_queue, [groups*rcout, cin, H*W], None, x, grad_output, dw, *conv_args)
+    prg.convx(ctx.cl_queue, [bs*groups, cin, iy*ix], None, w, grad_output, dx, *conv_args)
+    return dx, dw
 
 register('conv2d', Conv2D, gpu=True)
 
@@ -11,6 +11,8 @@ from froog.tensor import Tensor, GPU
 
 class Optimizer:
   def __init__(self, params):
+    if any(t.bf16 for t in params):
+      raise TypeError("bf16 tensors are inference only, optimize the float32 weights and call to_bf16() after")
     self.params = params
 
 class SGD(Optimizer):
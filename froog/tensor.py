@@ -13,6 +13,7 @@
 import os
 import numpy as np
 from inspect import signature
+from froog.utils import to_bf16, from_bf16, quantize
 
 try:
   import pyopencl as cl
@@ -45,7 +46,7 @@ def init_gpu():
 
 class Tensor:
   did_float_warning = False
-  def __init__(self, data, gpu=False):
+  def __init__(self, data, gpu=False, bf16=False):
     if isinstance(data, list):
       data = np.array(data, dtype=np.float32)
     elif GPU and isinstance(data, cl._cl.Buffer):
@@ -54,7 +55,7 @@ class Tensor:
       raise TypeError(f"Error constructing tensor with {data}")
     
     if isinstance(data, np.ndarray):
-      if data.dtype != np.float32 and not Tensor.did_float_warning:
+      if data.dtype != np.float32 and not bf16 and not Tensor.did_float_warning:
         # TODO: set env flag to print all warnings, float64 needed for numerical jacobian
         print(f"warning, {data.shape} isn't float32")
         if not os.getenv("DEBUG") == "1":
@@ -63,6 +64,7 @@ class Tensor:
 
     self.data = data
     self.grad = None
+    self.bf16 = bf16 # data is bfloat16 bits in a uint16 array, see to_bf16
 
     if gpu:
       self.gpu_()
@@ -96,6 +98,21 @@ class Tensor:
   def eye(dim):
     return Tensor(np.eye(dim).astype(np.float32))
 
+  def to_bf16(self):
+    """
+    returns a copy stored as bfloat16 bits (uint16), half the bytes of float32
+    inference only: every op sees it upcast to float32, it never gets a gradient and the optimizers refuse it
+    """
+    if self.gpu:
+      raise TypeError("to_bf16 needs a cpu tensor, call .to_cpu() first")
+    return Tensor(to_bf16(self.data), bf16=True)
+
+  def quantize(self, scale):
+    """
+    returns a symmetric int8 copy, self ~= scale * q. the weight and its scale go straight into qdot
+    """
+    return Tensor(quantize(self.data, scale, 0, np.int8))
+
   def backward(self, allow_fill=True): 
     if self._ctx is None:
       return
@@ -112,7 +129,7 @@ class Tensor:
     if len(self._ctx.parents) == 1:
       grads = [grads]
     for t, g in zip(self._ctx.parents, grads):
-      if g is None:
+      if g is None or t.bf16: # bf16 tensors are frozen
         continue
       if g.shape != t.data.shape:
         print(f"grad shape must match tensor shape in {self._ctx}, {g.shape} != {t.data.shape}")
@@ -203,7 +220,7 @@ class Function:
       setattr(ctx, k, v)                      # add any kwargs to ctx
 
     # this performs the actual operation (e.g., addition, multiplication, etc.) on the tensor data
-    ret = Tensor(op.forward(ctx, *[t.data for t in x], **kwargs))
+    ret = Tensor(op.forward(ctx, *[from_bf16(t.data) if t.bf16 else t.data for t in x], **kwargs))
     ret._ctx = ctx
     return ret
 
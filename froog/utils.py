@@ -7,7 +7,6 @@
 # |___|    |___|  |_||_______||_______||_______|
 
 import numpy as np
-from functools import lru_cache
 import pathlib, hashlib, os, tempfile, urllib
 
 def fetch(url):
@@ -35,48 +34,55 @@ def fetch_mnist():
   Y_test = parse(fetch(f"{BASE_URL}t10k-labels-idx1-ubyte.gz"))[8:].astype(np.int8)
   return X_train, Y_train, X_test, Y_test
 
+def quantize(x, scale, zp, dtype):
+  """
+  affine quantization, x ~= scale * (q - zp), clipped to the range of the integer dtype
+  """
+  info = np.iinfo(dtype)
+  return np.clip(np.round(x / scale) + zp, info.min, info.max).astype(dtype)
+
+def to_bf16(x):
+  """
+  bfloat16 is the top 16 bits of a float32, stored here as uint16. rounds to nearest even, NaN stays NaN
+  """
+  b = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+  ret = ((b + 0x7FFF + ((b >> 16) & 1)) >> 16).astype(np.uint16)
+  return np.where(np.isnan(x), np.uint16(0x7FC0), ret)
+
+def from_bf16(x):
+  u = x.astype(np.uint32)
+  return np.left_shift(u, 16, out=u).view(np.float32)  # zero-fill the low mantissa bits, in place so one fp32-sized buffer per use
+
 def mask_like(like, mask_inx, mask_value=1.0):
   mask = np.zeros_like(like).reshape(-1) # flatten
   mask[mask_inx] = mask_value            # fill 
   return mask.reshape(like.shape)
 
-@lru_cache
-def get_im2col_index(oy, ox, cin, H, W):
-  idx_channel = np.tile(np.arange(cin).repeat(H*W), oy*ox)
-  idx_y = np.tile(np.arange(H).repeat(W), oy*ox*cin) + np.arange(oy).repeat(ox*cin*H*W)
-  idx_x = np.tile(np.arange(W), oy*ox*cin*H) + np.tile(np.arange(ox), oy).repeat(cin*H*W)
-  OY, OX = oy+(H-1), ox+(W-1)
-  idx = idx_channel * OY * OX + idx_y * OX + idx_x
-  return idx
-
-@lru_cache
-def rearrange_col2im_index(oy, ox, cin, H, W):
-  idx = get_im2col_index(oy, ox, cin, H, W)
-  r_idx = np.zeros((np.max(idx)+1, H*W), dtype=idx.dtype)-1
-  for i,x in enumerate(idx):
-    for j in range(H*W):
-      if r_idx[x,j] == -1:
-        r_idx[x,j] = i
-        break
-  return r_idx
-
 # im2col convolution helpers
-def im2col(x, H, W):
-  bs, cin, oy, ox = x.shape[0], x.shape[1], x.shape[2]-(H-1), x.shape[3]-(W-1)
-  idx = get_im2col_index(oy, ox, cin, H, W)
-  tx = x.reshape(bs, -1)[:, idx]
-
-  # all the time is spent here
-  # np.ravel() flattens the array into a 1-dimensional shape
-  tx = tx.ravel()
-  return tx.reshape(-1, cin*W*H)
+def im2col(x, H, W, stride=(1,1), out=None):
+  """
+  returns (bs, cin*H*W, oy*ox), one column per output pixel, so w.reshape(cout, -1) @ cols is already NCHW
+  out: optional preallocated buffer of that shape to gather into instead of allocating
+  """
+  sy, sx = stride
+  bs, cin, oy, ox = x.shape[0], x.shape[1], (x.shape[2]-H)//sy+1, (x.shape[3]-W)//sx+1
+  s0, s1, s2, s3 = x.strides
+  # zero-copy view of every receptive field, (bs, cin, H, W, oy, ox)
+  view = np.lib.stride_tricks.as_strided(x, shape=(bs, cin, H, W, oy, ox), strides=(s0, s1, s2, s3, s2*sy, s3*sx), writeable=False)
+  if out is None:
+    return np.ascontiguousarray(view).reshape(bs, cin*H*W, oy*ox)   # the only copy, done in C
+  np.copyto(out.reshape(bs, cin, H, W, oy, ox), view)
+  return out
 
-def col2im(tx, H, W, OY, OX):
-  oy, ox = OY-(H-1), OX-(W-1)
-  bs = tx.shape[0] // (oy * ox)
+def col2im(tx, H, W, OY, OX, stride=(1,1)):
+  sy, sx = stride
+  oy, ox = (OY-H)//sy+1, (OX-W)//sx+1
+  bs = tx.shape[0]
   channels_in = tx.shape[1] // (H * W)
 
-  ridx = rearrange_col2im_index(oy, ox, channels_in, H, W)
-  # -1 has to be 0s
-  x = np.pad(tx.reshape(bs, -1), ((0,0),(0,1)))[:, ridx].sum(axis=2)
-  return x.reshape(bs, channels_in, OY, OX)
\ No newline at end of file
+  cols = tx.reshape(bs, channels_in, H, W, oy, ox)
+  x = np.zeros((bs, channels_in, OY, OX), dtype=tx.dtype)                        # rows/cols no kernel reaches keep zero gradient
+  for Y in range(H):
+    for X in range(W):
+      x[:, :, Y:Y+(oy-1)*sy+1:sy, X:X+(ox-1)*sx+1:sx] += cols[:, :, Y, X]          # each kernel offset covers a strided grid of pixels
+  return x
@@ -1,10 +1,20 @@
 import numpy as np
 from froog.tensor import Tensor, GPU
+import froog.ops
+from extra import kernels
+import extra.qdot
 import torch
 import unittest
 import timeit
 import functools
 
+def benchmark(fxn, repeat=7, number=10):
+  """
+  steady-state ms per call: warm up first so one-time JIT/alloc/cache costs are excluded, then take the best repeat
+  """
+  fxn(); fxn()
+  return min(timeit.Timer(fxn).repeat(repeat=repeat, number=number)) * 1000/number
+
 def helper_test_op(shape, torch_func, froog_func, atol=1e-7, grad_atol=1e-7, gpu=False, forward_only=False):
   torch_tensors = [torch.rand(x, requires_grad=True) for x in shape]
   froog_tensors = [Tensor(x.detach().numpy()) for x in torch_tensors]
@@ -25,13 +35,13 @@ def helper_test_op(shape, torch_func, froog_func, atol=1e-7, grad_atol=1e-7, gpu
 
   # test for speed
   # forward passes
-  torch_fwd = timeit.Timer(functools.partial(torch_func, *torch_tensors)).timeit(5) * 1000/5
-  froog_fwd = timeit.Timer(functools.partial(froog_func, *froog_tensors)).timeit(5) * 1000/5
+  torch_fwd = benchmark(functools.partial(torch_func, *torch_tensors))
+  froog_fwd = benchmark(functools.partial(froog_func, *froog_tensors))
 
   # backward passes
   if not forward_only:
-    torch_fbp = timeit.Timer(functools.partial(lambda f,x: f(*x).mean().backward(), torch_func, torch_tensors)).timeit(5) * 1000/5
-    froog_fbp = timeit.Timer(functools.partial(lambda f,x: f(*x).mean().backward(), froog_func, froog_tensors)).timeit(5) * 1000/5
+    torch_fbp = benchmark(functools.partial(lambda f,x: f(*x).mean().backward(), torch_func, torch_tensors))
+    froog_fbp = benchmark(functools.partial(lambda f,x: f(*x).mean().backward(), froog_func, froog_tensors))
   else:
     torch_fbp, froog_fbp = np.nan, np.nan
 
@@ -49,10 +59,23 @@ class TestOps(unittest.TestCase):
   def test_mul(self): helper_test_op([(45,65), (45,65)], lambda x,y: x*y, Tensor.mul, gpu=self.gpu)
   # **************** Dot ****************
   def test_dot(self): helper_test_op([(45,65), (65,100)], lambda x,y: x.matmul(y), Tensor.dot, atol=1e-5, gpu=self.gpu)
+  def test_dot_bf16(self): helper_test_op([(45,65), (65,100)], lambda x,y: x.matmul(y), lambda x,y: x.dot(y.to_bf16()), atol=5e-2, forward_only=True)
+  def test_qdot(self):
+    vnni = kernels.VNNI
+    try:
+      for use_vnni in {False, kernels.qgemm_vnni() is not None}:
+        kernels.VNNI = use_vnni
+        helper_test_op([(45,65), (65,100)], lambda x,y: x.matmul(y), Tensor.qdot, atol=0.15, grad_atol=1e-5)
+        helper_test_op([(45,65), (65,100)], lambda x,y: x.matmul(y),
+                        lambda x,y: x.qdot(y.quantize(s := np.abs(y.data).max(axis=0)/127), scale=s), atol=0.15, forward_only=True)
+        helper_test_op([(3,15,65), (65,100)], lambda x,y: x.matmul(y), Tensor.qdot, atol=0.15, grad_atol=1e-5)
+    finally:
+      kernels.VNNI = vnni
   # **************** Div ****************
   def test_div(self): helper_test_op([(45,65), (45,65)], lambda x,y: x/y, Tensor.div, atol=1e-3, grad_atol=1e-3, gpu=self.gpu)
   # **************** Pow ****************
   def test_pow(self): helper_test_op([(45,65), (45,65)], lambda x,y: x**y, Tensor.pow, gpu=self.gpu)
+  def test_pow_int(self): helper_test_op([(45,65)], lambda x: x**2, lambda x: x.pow(Tensor(np.array([2], dtype=np.float32))), atol=1e-6, grad_atol=1e-6)
   # **************** Sqrt ****************
   def test_sqrt(self): helper_test_op([(45,65)], lambda x: x.sqrt(), Tensor.sqrt, gpu=self.gpu)
   # **************** Conv ****************
@@ -64,7 +87,7 @@ class TestOps(unittest.TestCase):
             for W in [1,2,3,5]:
               helper_test_op([(bs,cin,11,28), (6,cin//groups,H,W)],
                 lambda x,w: torch.nn.functional.conv2d(x,w,groups=groups).relu(),
-                lambda x,w: Tensor.conv2d(x,w,groups=groups).relu(), atol=2e-5, grad_atol=2e-6, forward_only=self.gpu)
+                lambda x,w: Tensor.conv2d(x,w,groups=groups).relu(), atol=2e-5, grad_atol=2e-6, gpu=self.gpu)
   def test_strided_conv2d(self):
     bs = 4
     cin = 3
@@ -72,11 +95,24 @@ class TestOps(unittest.TestCase):
     helper_test_op([(bs,cin,11,28), (4,cin,H,W)],
                     lambda x,w: torch.nn.functional.conv2d(x,w,stride=2).relu(),
                     lambda x,w: Tensor.conv2d(x,w,stride=2).relu(), 
-                    atol=2e-5, grad_atol=2e-6, forward_only=self.gpu)
+                    atol=2e-5, grad_atol=2e-6, gpu=self.gpu)
     helper_test_op([(bs,cin,11,28), (4,cin,H,W)],
                     lambda x,w: torch.nn.functional.conv2d(x,w,stride=(2,1)).relu(),
                     lambda x,w: Tensor.conv2d(x,w,stride=(2,1)).relu(),
-                    atol=2e-5, grad_atol=2e-6, forward_only=self.gpu)
+                    atol=2e-5, grad_atol=2e-6, gpu=self.gpu)
+  def test_narrow_conv2d(self): helper_test_op([(4,3,11,7), (20,3,3,3)], lambda x,w: torch.nn.functional.conv2d(x,w).relu(), lambda x,w: Tensor.conv2d(x,w).relu(), atol=2e-5, grad_atol=2e-6, gpu=self.gpu)
+
+  def test_im2col_conv2d(self):
+    if self.gpu: self.skipTest("im2col is the CPU path")
+    avx2, kernels.AVX2 = kernels.AVX2, False # no fused kernel, im2col + GEMM
+    try:
+      for groups, stride in [(1,1), (3,(2,1))]:
+        helper_test_op([(4,6,11,28), (6,6//groups,3,3)],
+                        lambda x,w: torch.nn.functional.conv2d(x,w,stride=stride,groups=groups).relu(),
+                        lambda x,w: Tensor.conv2d(x,w,stride=stride,groups=groups).relu(),
+                        atol=2e-5, grad_atol=2e-6)
+    finally:
+      kernels.AVX2 = avx2
 
   # **************** Max Pool ****************
   def test_maxpool_sizes(self):
@@ -89,6 +125,9 @@ class TestOps(unittest.TestCase):
   def test_avgpool2x2(self): helper_test_op([(32,2,111,28)], lambda x: torch.nn.functional.avg_pool2d(x, (2,2)), Tensor.avg_pool2d, gpu=self.gpu, forward_only=self.gpu)
   # **************** Activations ****************
   def test_relu(self): helper_test_op([(45,65)], lambda x: x.relu(), Tensor.relu, gpu=self.gpu)
+  def test_sigmoid(self): helper_test_op([(45,65)], lambda x: x.sigmoid(), Tensor.sigmoid, gpu=self.gpu)
+  def test_relu_bf16(self): helper_test_op([(45,65)], lambda x: x.relu(), lambda x: x.to_bf16().relu(), atol=5e-3, forward_only=True)
+  def test_logsoftmax(self): helper_test_op([(45,65)], lambda x: torch.nn.functional.log_softmax(x, dim=1), Tensor.logsoftmax, atol=1e-6, grad_atol=1e-6, gpu=self.gpu)
   # **************** Padding ****************
   def test_pad2d(self): helper_test_op([(3,3,3,3)], lambda x: torch.nn.functional.pad(x, (1,1,1,1)), lambda x: x.pad2d(padding=(1,1,1,1)), gpu=self.gpu, forward_only=True)
 